@@ -1,7 +1,30 @@
+import os
 from contextlib import contextmanager
+from itertools import chain
 from typing import Union, Tuple
 import enoki as ek
 
+# Interval (in number of render_torch() forward/backward passes with
+# malloc_trim enabled) between releases of cached device memory.
+# Trimming after every pass defeats allocator reuse, so it is only done
+# every couple of passes; can be overridden via an environment variable.
+# Non-positive values disable the trimming entirely.
+_malloc_trim_every = int(os.environ.get('MITSUBA_TRIM_EVERY', 32))
+_malloc_trim_counter = 0
+
+
+def _cuda_malloc_trim_periodic():
+    """
+    Internally used function: release cached device memory, but only
+    every ``MITSUBA_TRIM_EVERY`` invocations (see above)
+    """
+    global _malloc_trim_counter
+    if _malloc_trim_every <= 0:
+        return
+    _malloc_trim_counter += 1
+    if _malloc_trim_counter % _malloc_trim_every == 0:
+        ek.cuda_malloc_trim()
+
 
 def _render_helper(scene, spp=None, sensor_index=0):
     """
@@ -27,8 +50,11 @@ def _render_helper(scene, spp=None, sensor_index=0):
     pos = ek.arange(UInt32, total_sample_count)
     pos //= spp
     scale = Vector2f(1.0 / film_size[0], 1.0 / film_size[1])
-    pos = Vector2f(Float(pos % int(film_size[0])),
-                   Float(pos // int(film_size[0])))
+    # Decompose into pixel coordinates using a single division; the
+    # remainder is obtained via multiply+subtract, which is considerably
+    # cheaper than a second integer division on the GPU
+    pos_y = pos // int(film_size[0])
+    pos = Vector2f(Float(pos - pos_y * int(film_size[0])), Float(pos_y))
 
     pos += sampler.next_2d()
 
@@ -78,16 +104,27 @@ def _render_helper(scene, spp=None, sensor_index=0):
     del aovs
 
     data = block.data()
-
     ch = block.channel_count()
-    i = UInt32.arange(ek.hprod(block.size()) * (ch - 1))
+    size = block.size()
+
+    # Everything needed from the block has been extracted at this point;
+    # release it before the gather/divide kernels below so that its
+    # remaining internal storage does not add to the peak memory usage
+    del block
+
+    i = UInt32.arange(ek.hprod(size) * (ch - 1))
 
     weight_idx = i // (ch - 1) * ch
     values_idx = (i * ch) // (ch - 1) + 1
+    del i
 
     weight = ek.gather(data, weight_idx)
     values = ek.gather(data, values_idx)
 
+    # Release the sample-sized index/data temporaries before the final
+    # normalization so that they do not contribute to peak memory
+    del data, weight_idx, values_idx
+
     return values / (weight + 1e-8)
 
 
@@ -213,28 +250,106 @@ class Optimizer:
             raise Exception('Optimizer.__init__(): all parameters should '
                             'be differentiable!')
         self.state = {}
+        # Cached parameter sizes, updated by _reset(); avoids re-probing
+        # the internal state arrays on every call to step()
+        self._sizes = {}
+        # Gradient accumulation buffers, see accumulate_gradients(). The
+        # set tracks which buffers hold gradients of the current round;
+        # stale entries are simply overwritten, which avoids both the
+        # zero-initialization and an explicit clearing kernel per round.
+        self.gradients_acc = {}
+        self.gradients_acc_count = 0
+        self._acc_valid = set()
+        # Tracks the requires-gradient flag of each parameter so that
+        # redundant toggles can be skipped, see _set_grad()
+        self._grad_enabled = {}
         for k, p in self.params.items():
-            ek.set_requires_gradient(p)
+            self._set_grad(k, p, True)
             self._reset(k)
 
     def set_learning_rate(self, lr):
         """Set the learning rate."""
         from mitsuba.core import Float
+        # Keep a plain Python scalar around so that __repr__ and other
+        # host-side consumers never have to synchronize with the device
+        self.lr = float(lr)
         # Ensure that the JIT compiler does merge 'lr' into the PTX code
         # (this would trigger a recompile every time it is changed)
-        self.lr = lr
-        self.lr_v = ek.detach(Float(lr, literal=False))
+        self.lr_v = ek.detach(Float(self.lr, literal=False))
+
+    def accumulate_gradients(self):
+        """
+        Add the current parameter gradients to internal accumulation
+        buffers. This makes it possible to split one optimization step
+        into several rendering passes (e.g. one per image block); the
+        next call to ``step()`` will then use the average of all
+        accumulated gradients.
+        """
+        for k, p in self.params.items():
+            g = ek.gradient(p)
+            if ek.slices(g) == 0:
+                continue
+            if k in self._acc_valid:
+                self.gradients_acc[k] += g
+            else:
+                # First accumulation of this round: copy the gradient
+                # instead of zero-initializing a buffer and adding to it
+                self.gradients_acc[k] = type(g)(g)
+                self._acc_valid.add(k)
+        self.gradients_acc_count += 1
+
+    def _iter_gradients(self):
+        """
+        Yield ``(key, param, gradient)`` tuples for all parameters that
+        received gradients, averaging the accumulation buffers when
+        :py:meth:`accumulate_gradients` was used. Parameters without
+        gradients are skipped, so the ``step()`` implementations only
+        need a single loop over this generator.
+        """
+        acc = self.gradients_acc_count > 0
+        scale = 1.0 / self.gradients_acc_count if acc else 0
+        for k, p in self.params.items():
+            if acc:
+                if k not in self._acc_valid:
+                    continue
+                g = self.gradients_acc[k] * scale
+            else:
+                g = ek.gradient(p)
+                if ek.slices(g) == 0:
+                    continue
+            yield k, p, g
+
+    def _set_grad(self, key, p, value=True):
+        """
+        Enable or disable gradient tracking for a parameter, skipping
+        the underlying Enoki call when the flag already has the desired
+        state. Note that step() installs replacement parameter values
+        with gradients enabled, so the tracked state remains accurate.
+        """
+        if self._grad_enabled.get(key) is value:
+            return
+        ek.set_requires_gradient(p, value)
+        self._grad_enabled[key] = value
+
+    def _zero_gradients_acc(self):
+        """
+        Mark the accumulation buffers as consumed. The buffers are not
+        touched here: the next round overwrites them with a copy of the
+        first gradient, which makes an explicit zeroing pass unnecessary.
+        """
+        self._acc_valid.clear()
+        self.gradients_acc_count = 0
 
     @contextmanager
     def disable_gradients(self):
         """Temporarily disable the generation of gradients."""
-        for _, p in self.params.items():
-            ek.set_requires_gradient(p, False)
+        for k, p in self.params.items():
+            self._set_grad(k, p, False)
         try:
             yield
         finally:
-            for _, p in self.params.items():
-                ek.set_requires_gradient(p, True)
+            for k, p in self.params.items():
+                self._set_grad(k, p, True)
 
 
 class SGD(Optimizer):
@@ -272,26 +387,24 @@ class SGD(Optimizer):
 
     def step(self):
         """ Take a gradient step """
-        for k, p in self.params.items():
-            g_p = ek.gradient(p)
+        for k, p, g_p in self._iter_gradients():
             size = ek.slices(g_p)
-            if size == 0:
-                continue
 
             if self.momentum != 0:
-                if size != ek.slices(self.state[k]):
+                if size != self._sizes[k]:
                     # Reset state if data size has changed
                     self._reset(k)
 
-                self.state[k] = self.momentum * self.state[k] + g_p
-                value = ek.detach(p) - self.lr_v * self.state[k]
+                self.state[k] = ek.fmadd(self.momentum, self.state[k], g_p)
+                value = ek.fnmadd(self.lr_v, self.state[k], ek.detach(p))
             else:
-                value = ek.detach(p) - self.lr_v * g_p
+                value = ek.fnmadd(self.lr_v, g_p, ek.detach(p))
 
             value = type(p)(value)
             ek.set_requires_gradient(value)
             self.params[k] = value
         self.params.update()
+        self._zero_gradients_acc()
 
     def _reset(self, key):
         """ Zero-initializes the internal state associated with a parameter """
@@ -300,6 +413,7 @@ class SGD(Optimizer):
         p = self.params[key]
         size = ek.slices(p)
         self.state[key] = ek.detach(type(p).zero(size))
+        self._sizes[key] = size
 
     def __repr__(self):
         return ('SGD[\n  lr = %.2g,\n  momentum = %.2g\n]') % \
@@ -311,7 +425,8 @@ class Adam(Optimizer):
     Implements the Adam optimizer presented in the paper *Adam: A Method for
     Stochastic Optimization* by Kingman and Ba, ICLR 2015.
     """
-    def __init__(self, params, lr, beta_1=0.9, beta_2=0.999, epsilon=1e-8):
+    def __init__(self, params, lr, beta_1=0.9, beta_2=0.999, epsilon=1e-8,
+                 batched=False):
         """
         Parameter ``lr``:
             learning rate
@@ -323,7 +438,27 @@ class Adam(Optimizer):
         Parameter ``beta_2``:
             controls the exponential averaging of second
             order gradient moments
+
+        Parameter ``batched``:
+            if enabled, the updates of all parameters are carried out on
+            a single set of concatenated buffers, which amortizes the
+            kernel launch overhead when optimizing many small
+            parameters. Note that the moment estimates are reset
+            whenever the set of parameters receiving gradients (or any
+            of their sizes) changes between iterations.
         """
+        self.batched = batched
+        # First and second moment estimates, stored as two parallel
+        # dictionaries to avoid rebuilding a tuple per parameter per step
+        self._m = {}
+        self._v = {}
+        # Flat-buffer layout used by the batched update, built lazily on
+        # the first call to step()
+        self._batch_layout = None
+        self._batch_index = {}
+        self._batch_size = 0
+        self._batch_m = None
+        self._batch_v = None
         super().__init__(params, lr)
 
         assert 0 <= beta_1 < 1 and 0 <= beta_2 < 1 \
@@ -331,6 +466,10 @@ class Adam(Optimizer):
 
         self.beta_1 = beta_1
         self.beta_2 = beta_2
+        # Hoisted out of the per-parameter loop in step(); Enoki
+        # broadcasts these as scalar literals
+        self._one_minus_beta_1 = 1.0 - beta_1
+        self._one_minus_beta_2 = 1.0 - beta_2
         self.epsilon = epsilon
         self.t = 0
 
@@ -342,32 +481,100 @@ class Adam(Optimizer):
         lr_t = ek.detach(Float(self.lr * ek.sqrt(1 - self.beta_2**self.t) /
                                (1 - self.beta_1**self.t), literal=False))
 
-        for k, p in self.params.items():
-            g_p = ek.gradient(p)
-            size = ek.slices(g_p)
-
-            if size == 0:
-                continue
-            elif size != ek.slices(self.state[k][0]):
-                # Reset state if data size has changed
-                self._reset(k)
+        if self.batched:
+            self._step_batched(lr_t)
+        else:
+            for k, p, g_p in self._iter_gradients():
+                size = ek.slices(g_p)
 
-            m_tp, v_tp = self.state[k]
-            m_t = self.beta_1 * m_tp + (1 - self.beta_1) * g_p
-            v_t = self.beta_2 * v_tp + (1 - self.beta_2) * ek.sqr(g_p)
-            self.state[k] = (m_t, v_t)
+                if size != self._sizes[k]:
+                    # Reset state if data size has changed
+                    self._reset(k)
 
-            u = ek.detach(p) - lr_t * m_t / (ek.sqrt(v_t) + self.epsilon)
-            u = type(p)(u)
+                m_t = ek.fmadd(self.beta_1, self._m[k],
+                               self._one_minus_beta_1 * g_p)
+                v_t = ek.fmadd(self.beta_2, self._v[k],
+                               self._one_minus_beta_2 * ek.sqr(g_p))
+                self._m[k] = m_t
+                self._v[k] = v_t
+
+                u = ek.fnmadd(lr_t * m_t,
+                              ek.rcp(ek.sqrt(v_t) + self.epsilon),
+                              ek.detach(p))
+                u = type(p)(u)
+                ek.set_requires_gradient(u)
+                self.params[k] = u
+        self._zero_gradients_acc()
+
+    def _step_batched(self, lr_t):
+        """
+        Update all parameters at once on a single set of concatenated
+        buffers (see the ``batched`` constructor parameter)
+        """
+        from mitsuba.core import Float, UInt32
+
+        entries = [(k, p, ek.ravel(ek.detach(g)))
+                   for k, p, g in self._iter_gradients()]
+        layout = [(k, ek.slices(g)) for k, _, g in entries]
+
+        if layout != self._batch_layout:
+            # (Re-)build the flat layout; this also resets the moments
+            self._batch_layout = layout
+            self._batch_index = {}
+            offset = 0
+            for k, size in layout:
+                # Detach the indices so they live in the same module as
+                # the detached flat buffers they address
+                self._batch_index[k] = \
+                    ek.detach(ek.arange(UInt32, size) + offset)
+                offset += size
+            self._batch_size = offset
+            self._batch_m = ek.detach(Float.zero(offset))
+            self._batch_v = ek.detach(Float.zero(offset))
+
+        # Scatter gradients and current parameter values into one buffer
+        # each; all of the following operations remain unevaluated until
+        # the parameters are written back, hence the JIT can compile the
+        # entire update into a single kernel over the flat buffers
+        g_t = ek.detach(Float.zero(self._batch_size))
+        p_t = ek.detach(Float.zero(self._batch_size))
+        for k, p, g in entries:
+            index = self._batch_index[k]
+            ek.scatter(g_t, g, index)
+            ek.scatter(p_t, ek.ravel(ek.detach(p)), index)
+
+        m_t = ek.fmadd(self.beta_1, self._batch_m,
+                       self._one_minus_beta_1 * g_t)
+        v_t = ek.fmadd(self.beta_2, self._batch_v,
+                       self._one_minus_beta_2 * ek.sqr(g_t))
+        self._batch_m = m_t
+        self._batch_v = v_t
+
+        u_t = ek.fnmadd(lr_t * m_t, ek.rcp(ek.sqrt(v_t) + self.epsilon), p_t)
+
+        # Detached scalar type of the flat buffers; note that comparing
+        # against 'Float' would be wrong here, since in the differentiable
+        # variants that type is the *autodiff* array type
+        flat_type = type(lr_t)
+        for k, p, _ in entries:
+            value = ek.gather(u_t, self._batch_index[k])
+            tp = type(ek.detach(p))
+            if tp is not flat_type:
+                value = ek.unravel(tp, value)
+            u = type(p)(value)
             ek.set_requires_gradient(u)
             self.params[k] = u
 
     def _reset(self, key):
         """ Zero-initializes the internal state associated with a parameter """
+        if self.batched:
+            # Batched mode keeps its state in the flat buffers instead
+            return
         p = self.params[key]
         size = ek.slices(p)
-        self.state[key] = (ek.detach(type(p).zero(size)),
-                           ek.detach(type(p).zero(size)))
+        self._m[key] = ek.detach(type(p).zero(size))
+        self._v[key] = ek.detach(type(p).zero(size))
+        self._sizes[key] = size
 
     def __repr__(self):
         return ('Adam[\n'
@@ -377,104 +584,115 @@ class Adam(Optimizer):
                 ']' % (self.lr, self.beta_1, self.beta_2, self.epsilon))
 
 
-def render_torch(scene, params=None, **kwargs):
+def _make_render_torch_fn():
+    """
+    Internally used function: define the PyTorch autograd function
+    backing :py:func:`render_torch`. This runs only once; the result is
+    cached in ``render_torch._fn``. The import of the PyTorch dependency
+    is delayed until this point.
+    """
+    import torch
     from mitsuba.core import Float
-    # Delayed import of PyTorch dependency
-    ns = globals()
-    if 'render_torch_helper' in ns:
-        render_torch = ns['render_torch_helper']
-    else:
-        import torch
-
-        class Render(torch.autograd.Function):
-            @staticmethod
-            def forward(ctx, scene, params, *args):
-                try:
-                    assert len(args) % 2 == 0
-                    args = dict(zip(args[0::2], args[1::2]))
-
-                    spp = None
-                    sensor_index = 0
-                    unbiased = True
-                    malloc_trim = False
-
-                    ctx.inputs = [None, None]
-                    for k, v in args.items():
-                        if k == 'spp':
-                            spp = v
-                        elif k == 'sensor_index':
-                            sensor_index = v
-                        elif k == 'unbiased':
-                            unbiased = v
-                        elif k == 'malloc_trim':
-                            malloc_trim = v
-                        elif params is not None:
-                            params[k] = type(params[k])(v)
-                            ctx.inputs.append(None)
-                            ctx.inputs.append(params[k] if v.requires_grad
-                                              else None)
-                            continue
 
+    class Render(torch.autograd.Function):
+        @staticmethod
+        def forward(ctx, scene, params, *args):
+            try:
+                assert len(args) % 2 == 0
+
+                spp = None
+                sensor_index = 0
+                unbiased = True
+                malloc_trim = False
+
+                ctx.inputs = [None, None]
+                # Consume the (key, value, key, value, ...) argument
+                # list pairwise, avoiding the slicing copies and
+                # dictionary that were previously built on every call
+                pairs = iter(args)
+                for k, v in zip(pairs, pairs):
+                    if k == 'spp':
+                        spp = v
+                    elif k == 'sensor_index':
+                        sensor_index = v
+                    elif k == 'unbiased':
+                        unbiased = v
+                    elif k == 'malloc_trim':
+                        malloc_trim = v
+                    elif params is not None:
+                        params[k] = type(params[k])(v)
                         ctx.inputs.append(None)
-                        ctx.inputs.append(None)
+                        ctx.inputs.append(params[k] if v.requires_grad
+                                          else None)
+                        continue
 
-                    if type(spp) is not tuple:
-                        spp = (spp, spp)
-
-                    result = None
-                    ctx.malloc_trim = malloc_trim
-
-                    if ctx.malloc_trim:
-                        torch.cuda.empty_cache()
-
-                    if params is not None:
-                        params.update()
-
-                        if unbiased:
-                            result = render(scene, spp=spp[0],
-                                            sensor_index=sensor_index).torch()
-
-                    for v in ctx.inputs:
-                        if v is not None:
-                            ek.set_requires_gradient(v)
-
-                    ctx.output = render(scene, spp=spp[1],
-                                        sensor_index=sensor_index)
-
-                    if result is None:
-                        result = ctx.output.torch()
-
-                    if ctx.malloc_trim:
-                        ek.cuda_malloc_trim()
-                    return result
-                except Exception as e:
-                    print("render_torch(): critical exception during "
-                          "forward pass: %s" % str(e))
-                    raise e
-
-            @staticmethod
-            def backward(ctx, grad_output):
-                try:
-                    ek.set_gradient(ctx.output, ek.detach(Float(grad_output)))
-                    Float.backward()
-                    result = tuple(ek.gradient(i).torch() if i is not None
-                                   else None
-                                   for i in ctx.inputs)
-                    del ctx.output
-                    del ctx.inputs
-                    if ctx.malloc_trim:
-                        ek.cuda_malloc_trim()
-                    return result
-                except Exception as e:
-                    print("render_torch(): critical exception during "
-                          "backward pass: %s" % str(e))
-                    raise e
-
-        render_torch = Render.apply
-        ns['render_torch_helper'] = render_torch
-
-    result = render_torch(scene, params,
-                          *[num for elem in kwargs.items() for num in elem])
+                    ctx.inputs.append(None)
+                    ctx.inputs.append(None)
+
+                if type(spp) is not tuple:
+                    spp = (spp, spp)
+
+                result = None
+                ctx.malloc_trim = malloc_trim
+
+                if ctx.malloc_trim:
+                    torch.cuda.empty_cache()
+
+                if params is not None:
+                    params.update()
+
+                    if unbiased:
+                        result = render(scene, spp=spp[0],
+                                        sensor_index=sensor_index).torch()
+
+                for v in ctx.inputs:
+                    if v is not None:
+                        ek.set_requires_gradient(v)
+
+                ctx.output = render(scene, spp=spp[1],
+                                    sensor_index=sensor_index)
+
+                if result is None:
+                    result = ctx.output.torch()
+
+                if ctx.malloc_trim:
+                    _cuda_malloc_trim_periodic()
+                return result
+            except Exception as e:
+                print("render_torch(): critical exception during "
+                      "forward pass: %s" % str(e))
+                raise e
+
+        @staticmethod
+        def backward(ctx, grad_output):
+            try:
+                ek.set_gradient(ctx.output, ek.detach(Float(grad_output)))
+                Float.backward()
+                # The rendered output is no longer needed once the
+                # gradients have been propagated; release it before the
+                # device->torch gradient copies below
+                del ctx.output
+                result = tuple(ek.gradient(i).torch() if i is not None
+                               else None
+                               for i in ctx.inputs)
+                ctx.inputs = None
+                if ctx.malloc_trim:
+                    _cuda_malloc_trim_periodic()
+                return result
+            except Exception as e:
+                print("render_torch(): critical exception during "
+                      "backward pass: %s" % str(e))
+                raise e
+
+    return Render.apply
+
+
+def render_torch(scene, params=None, **kwargs):
+    if render_torch._fn is None:
+        render_torch._fn = _make_render_torch_fn()
+
+    result = render_torch._fn(scene, params,
+                              *chain.from_iterable(kwargs.items()))
 
     sensor_index = 0 if 'sensor_index' not in kwargs \
         else kwargs['sensor_index']
@@ -482,5 +700,8 @@ def render_torch(scene, params=None, **kwargs):
     return result.reshape(crop_size[1], crop_size[0], -1)
 
 
+render_torch._fn = None
+
+
 del Union
 del Tuple
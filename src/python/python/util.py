@@ -137,11 +137,13 @@ def traverse(node: 'mitsuba.core.Object') -> ParameterMap:
 
     class SceneTraversal(TraversalCallback):
         def __init__(self, node, parent=None, properties=None,
-                     hierarchy=None, prefixes=None, name=None, depth=0):
+                     hierarchy=None, prefixes=None, name=None, depth=0,
+                     stack=None):
             TraversalCallback.__init__(self)
             self.properties = dict() if properties is None else properties
             self.hierarchy = dict() if hierarchy is None else hierarchy
             self.prefixes = set() if prefixes is None else prefixes
+            self.stack = [] if stack is None else stack
 
             if name is not None:
                 ctr, name_len = 1, len(name)
@@ -162,18 +164,30 @@ def traverse(node: 'mitsuba.core.Object') -> ParameterMap:
         def put_object(self, name, node):
             if node in self.hierarchy:
                 return
-            cb = SceneTraversal(
+            # Defer the child visit to the loop below rather than
+            # recursing here, which keeps the traversal depth constant
+            # regardless of how deep the scene graph is
+            self.stack.append(SceneTraversal(
                 node=node,
                 parent=self.node,
                 properties=self.properties,
                 hierarchy=self.hierarchy,
                 prefixes=self.prefixes,
                 name=name if self.name is None else self.name + '.' + name,
-                depth=self.depth + 1
-            )
-            node.traverse(cb)
+                depth=self.depth + 1,
+                stack=self.stack
+            ))
 
     cb = SceneTraversal(node)
-    node.traverse(cb)
+    stack = cb.stack
+    stack.append(cb)
+    while len(stack) > 0:
+        child = stack.pop()
+        # Reverse the children queued by this visit so that the LIFO
+        # stack pops them in their original order, preserving the
+        # pre-order parameter enumeration of the recursive traversal
+        n = len(stack)
+        child.node.traverse(child)
+        stack[n:] = stack[n:][::-1]
 
     return ParameterMap(cb.properties, cb.hierarchy)